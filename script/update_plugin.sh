@@ -2,6 +2,9 @@
 
 sourceDir=$1
 targetDir=$2
+# Optional: where manifests and their ETags are kept between runs, so that
+# unchanged manifests are answered with an empty 304 instead of a download.
+cacheDir=$3
 
 if [ -z "$sourceDir" ]; then
   echo "sourceDir is required"
@@ -17,87 +20,326 @@ if [ ! -d "$targetDir" ]; then
   mkdir -p $targetDir
 fi
 
-git config --local user.email "41898282+github-actions[bot]@users.noreply.github.com"
-git config --local user.name "github-actions[bot]"
+if [ -n "$cacheDir" ] && [ ! -d "$cacheDir" ]; then
+  mkdir -p $cacheDir
+fi
+
+# Only set the committer once, a rerun in the same checkout finds it in place.
+if ! git config --local --get user.email >/dev/null; then
+  git config --local user.email "41898282+github-actions[bot]@users.noreply.github.com"
+fi
+if ! git config --local --get user.name >/dev/null; then
+  git config --local user.name "github-actions[bot]"
+fi
 
-echo "Updating plugin index, sourceDir: $sourceDir, targetDir: $targetDir"
+echo "Updating plugin index, sourceDir: $sourceDir, targetDir: $targetDir, cacheDir: $cacheDir"
 
 indexJsonFile="$targetDir/index.json"
-tmpPluginJsonFile="tmp.json"
+# Download tuning, all in one place:
+#   maxParallel      manifests downloaded at the same time
+#   maxManifestSize  larger manifests are refused unread
+#   maxTransferTime  seconds a single attempt may take
+#   maxRetries       attempts after a timeout, 429 or 5xx answer
+maxParallel=32
+maxManifestSize=1M
+maxTransferTime=60
+maxRetries=5
+# Scratch files are kept in memory when the runner has a writable tmpfs at
+# /dev/shm, unless another location is chosen with TMPDIR.
+workDir=
+if [ -z "$TMPDIR" ] && [ -w /dev/shm ]; then
+  workDir=$(mktemp -d -p /dev/shm)
+fi
+if [ -z "$workDir" ]; then
+  workDir=$(mktemp -d)
+fi
+if [ -z "$workDir" ]; then
+  echo "Failed to create a scratch directory"
+  exit 1
+fi
+# Files in $targetDir are written to a .tmp sibling first and then renamed over
+# the original, which is atomic, so an interrupted run never leaves a torn file.
+trap 'rm -rf "$workDir" "$targetDir"/*.tmp' EXIT
 
-echo "[" >$indexJsonFile
+declare -A sourceNames manifestUrls currentVersions urlKeys sharedKeys
 
-for file in $sourceDir/*.json; do
-  sourceName=$(jq -r '.name' $file)
-  manifestUrl=$(jq -r '.manifestUrl' $file)
+# Process the downloaded manifest of a single source file. This runs as soon
+# as its transfer completes, so plugins are handled in completion order; the
+# results are left in $workDir for the collection step, which is ordered:
+#   <key>.index   the entry of the plugin in index.json, as compact JSON
+#   <key>.commit  "<pluginName> <newVersion>", only if the version changed
+process_plugin() {
+  local key=$1
+  local response=$2
+  # The key whose transfer fetched the manifest, which is another one than
+  # $key when several source files share the same manifest URL.
+  local downloadKey=${3:-$key}
+  local sourceName=${sourceNames[$key]}
+  local manifestUrl=${manifestUrls[$key]}
+  local tmpPluginJsonFile="$workDir/$downloadKey.manifest"
 
   echo "::::Processing [$sourceName] => [$manifestUrl]"
 
-  response=$(curl -# -o $tmpPluginJsonFile -w "%{http_code}" -L $manifestUrl)
-
-  if [ "$response" != "200" ]; then
+  if [ "$response" = "304" ]; then
+    echo "The manifest is not modified, using the cached one"
+    cp "$cacheDir/$downloadKey.json" $tmpPluginJsonFile
+  elif [ "$response" != "200" ]; then
     echo "Failed to download manifest: $manifestUrl"
-    continue
+    return
+  elif [ -n "$cacheDir" ] && [ "$downloadKey" = "$key" ]; then
+    # The ETag, the manifest it belongs to and the URL they were downloaded
+    # from are always cached together.
+    cp $tmpPluginJsonFile "$cacheDir/$key.json"
+    mv "$workDir/$key.etag" "$cacheDir/$key.etag"
+    echo "$manifestUrl" >"$cacheDir/$key.url"
   fi
 
-  pluginName=$(jq -r '.name' $tmpPluginJsonFile)
+  # Read every field we need in a single pass over the manifest, one per line,
+  # the last one being the entry of the plugin in index.json. Nothing is read
+  # from a manifest that is no object or whose name or version is no string.
+  {
+    read -r pluginName
+    read -r newVersion
+    read -r homepage
+    read -r indexEntry
+  } < <(jq -r 'objects | select((.name | type) == "string" and (.version | type) == "string")
+    | (.name, .version, .homepage | tostring | gsub("\n"; " ")), ({name, desc: .description, homepage} | tojson)' $tmpPluginJsonFile)
+
+  if [ -z "$pluginName" ]; then
+    echo "Invalid manifest, name and version are required: $manifestUrl"
+    return
+  fi
 
   # Check if the plugin name is consistent with the manifest name,
   # ensure that the manifest changes names randomly at a later stage,
   # which not affects the registry.
   if [ "$pluginName" != "$sourceName" ]; then
     echo "The manifest name is inconsistent with the recorded name: sourcePluginName => $sourceName, manifestPluginName => $pluginName"
-    continue
+    return
   fi
 
   # compare the version
   isEqualVersion=false
   pluginJsonFile="$targetDir/$pluginName.json"
-  if [ -f $pluginJsonFile ]; then
-    currentVersion=$(jq -r '.version' $pluginJsonFile)
-    newVersion=$(jq -r '.version' $tmpPluginJsonFile)
+  if [[ -v currentVersions[$pluginName] ]]; then
+    currentVersion=${currentVersions[$pluginName]}
     if [ "$currentVersion" = "$newVersion" ]; then
       echo "The version is the same: $currentVersion"
       isEqualVersion=true
     fi
   fi
 
-  newVersion=$(jq -r '.version' $tmpPluginJsonFile)
-
-  pluginJsonFile="$targetDir/$pluginName.json"
-
-  echo "::::Updating plugin json [$pluginJsonFile]"
-
-  jq . $tmpPluginJsonFile >$pluginJsonFile
-
   # 如果版本不一致,则需要提交
+  # Only a new version is ever committed, so an unchanged one is not rewritten.
   if [ "$isEqualVersion" = false ]; then
-    git add $pluginJsonFile
+    echo "::::Updating plugin json [$pluginJsonFile]"
+
+    jq . $tmpPluginJsonFile >"$pluginJsonFile.tmp"
+    mv "$pluginJsonFile.tmp" $pluginJsonFile
 
-    git commit -m "$pluginName: Update to version $newVersion" $pluginJsonFile
+    echo "$pluginName $newVersion" >"$workDir/$key.commit"
   fi
 
-  desc=$(jq -r '.description' $tmpPluginJsonFile)
-  homepage=$(jq -r '.homepage' $tmpPluginJsonFile)
   echo "::::Adding name:[$pluginName] homepage:[$homepage] to index"
-  echo "{ \"name\": \"$pluginName\", \"desc\": \"$desc\", \"homepage\": \"$homepage\" }," >>$indexJsonFile
+  echo "$indexEntry" >"$workDir/$key.index"
 
   echo "::::End processing [$sourceName]"
+}
 
-done
+# Read the current version of every plugin in a single jq pass, instead of
+# one per plugin. index.json is the only file in $targetDir that is no object.
+# jq stops at the first file it cannot parse, which would make every plugin
+# after it look new, so a broken plugin JSON aborts the run instead.
+currentVersionsFile="$workDir/current.versions"
+touch $currentVersionsFile
+if compgen -G "$targetDir/*.json" >/dev/null; then
+  if ! jq -r 'select(type == "object") | "\(input_filename) \(.version)"' $targetDir/*.json >$currentVersionsFile; then
+    echo "Failed to read the current plugin versions in $targetDir"
+    exit 1
+  fi
+fi
+
+while read -r pluginJsonFile version; do
+  pluginName=${pluginJsonFile##*/}
+  currentVersions[${pluginName%.json}]=$version
+done <$currentVersionsFile
+
+# All manifests are downloaded by a single curl process, so connections to
+# the same host (almost always github.com) are pooled and reused instead of
+# paying a TCP and TLS handshake per plugin, and up to $maxParallel transfers
+# run at the same time, multiplexed over HTTP/2 where the host supports it.
+# A manifest is a few hundred bytes, anything over $maxManifestSize is refused.
+# Timeouts, 429 and 5xx answers are retried with an exponential backoff (or
+# after the Retry-After the host asks for), so one flaky response from GitHub
+# does not drop the plugin from the run.
+# The source files are read by a single jq pass as well, in glob order, which
+# is also the order of the keys in $sourceKeys. As with the plugin versions, a
+# source file that jq cannot parse aborts the run before anything is fetched
+# or written, instead of silently dropping every source after it.
+if ! compgen -G "$sourceDir/*.json" >/dev/null; then
+  echo "No source files in $sourceDir"
+  exit 1
+fi
+
+sourcesFile="$workDir/sources.tsv"
+if ! jq -r '[input_filename, .name, .manifestUrl] | @tsv' $sourceDir/*.json >$sourcesFile; then
+  echo "Failed to read the source files in $sourceDir"
+  exit 1
+fi
+
+curlConfig="$workDir/curl.config"
+sourceKeys=()
+while IFS=$'\t' read -r file sourceName manifestUrl; do
+  file=${file##*/}
+  key=${file%.json}
+  sourceKeys+=("$key")
+  sourceNames[$key]=$sourceName
+  manifestUrls[$key]=$manifestUrl
 
-rm $tmpPluginJsonFile
+  # Every manifest URL is downloaded only once.
+  if [[ -v urlKeys[$manifestUrl] ]]; then
+    sharedKeys[${urlKeys[$manifestUrl]}]+=" $key"
+    continue
+  fi
+  urlKeys[$manifestUrl]=$key
+
+  # "next" separates the options of one transfer from those of the previous one.
+  if [ -s $curlConfig ]; then
+    echo "next" >>$curlConfig
+  fi
+  cat >>$curlConfig <<EOF
+url = "$manifestUrl"
+output = "$workDir/$key.manifest"
+location
+write-out = "%{http_code} %{exitcode} $key\n"
+max-filesize = $maxManifestSize
+max-time = $maxTransferTime
+retry = $maxRetries
+EOF
+
+  if [ -n "$cacheDir" ]; then
+    echo "etag-save = \"$workDir/$key.etag\"" >>$curlConfig
+    # The cached manifest is only valid for the URL it was downloaded from, a
+    # source whose manifestUrl changed is downloaded in full.
+    cachedUrl=
+    if [ -f "$cacheDir/$key.url" ]; then
+      read -r cachedUrl <"$cacheDir/$key.url"
+    fi
+    if [ -f "$cacheDir/$key.json" ] && [ "$cachedUrl" = "$manifestUrl" ]; then
+      # Hosts that send no ETag are asked with If-Modified-Since instead,
+      # against the time the cached manifest was stored.
+      if [ -s "$cacheDir/$key.etag" ]; then
+        echo "etag-compare = \"$cacheDir/$key.etag\"" >>$curlConfig
+      else
+        echo "time-cond = \"$cacheDir/$key.json\"" >>$curlConfig
+      fi
+    fi
+  fi
+done <$sourcesFile
+
+echo "::::Downloading ${#urlKeys[@]} manifests"
+
+# curl reports every transfer as it completes, so the local processing of the
+# manifests already downloaded overlaps with the transfers still in flight.
+while read -r response exitCode key; do
+  # An aborted transfer, e.g. one over max-filesize or max-time, can still
+  # report the status code of its response.
+  if [ "$exitCode" != "0" ]; then
+    response=000
+  fi
+
+  process_plugin $key $response
+  for sharedKey in ${sharedKeys[$key]}; do
+    process_plugin $sharedKey $response $key
+  done
+done < <(curl --no-progress-meter --parallel --parallel-max $maxParallel --config $curlConfig)
+
+# Collect the results in source order, so that the commit and the index stay
+# deterministic. Everything that changed is committed once, at the end.
+indexEntriesFile="$workDir/index.entries"
+touch $indexEntriesFile
+changedFiles=()
+updatedPlugins=()
+updateMessages=()
+missingPlugins=()
+exitCode=0
+
+# The current entry of every plugin in the index, by name. A source that gets
+# no entry in this run, e.g. because its manifest failed to download, keeps its
+# current one, so one broken upstream neither unpublishes the plugin nor holds
+# back the rest of the index.
+declare -A currentIndexEntries
+if [ -f $indexJsonFile ]; then
+  while read -r pluginName && read -r indexEntry; do
+    currentIndexEntries[$pluginName]=$indexEntry
+  done < <(jq -r '.[] | (.name, tojson)' $indexJsonFile)
+fi
+
+for key in "${sourceKeys[@]}"; do
+  if [ -f "$workDir/$key.commit" ]; then
+    read -r pluginName newVersion <"$workDir/$key.commit"
+    changedFiles+=("$targetDir/$pluginName.json")
+    updatedPlugins+=("$pluginName")
+    updateMessages+=("$pluginName: Update to version $newVersion")
+  fi
+
+  sourceName=${sourceNames[$key]}
+  if [ -f "$workDir/$key.index" ]; then
+    cat "$workDir/$key.index" >>$indexEntriesFile
+  elif [[ -v currentIndexEntries[$sourceName] ]]; then
+    echo "Keeping the current index entry of [$sourceName]"
+    echo "${currentIndexEntries[$sourceName]}" >>$indexEntriesFile
+  else
+    missingPlugins+=("$sourceName")
+  fi
+done
 
 echo "IndexJsonFile: $indexJsonFile"
 
-# Remove the last comma and add closing bracket
-sed -i '' -e '$ s/,$//' $indexJsonFile
-echo "]" >>$indexJsonFile
+# Let jq build the index, so that every value is encoded properly. It keeps the
+# existing layout, one entry per line in source order; that order comes from
+# the single glob over $sourceDir, so it is deterministic without sorting. The
+# index is only written, and compared with the committed one, when its
+# content changed.
+newIndexJsonFile="$indexJsonFile.tmp"
+jq -rs '"[",
+  (map("{ \"name\": \(.name | tojson), \"desc\": \(.desc | tojson), \"homepage\": \(.homepage | tojson) }")
+    | join(",\n") | select(length > 0)),
+  "]"' $indexEntriesFile >$newIndexJsonFile
 
-# Check if indexJsonFile has changes
-if git status --porcelain | grep -q "^ M plugins/index.json"; then
-  git add $indexJsonFile
-  git commit -m "Update plugin index" $indexJsonFile
+# A source with neither a new nor a current entry would leave the index with
+# fewer entries than there are sources. The current index is kept then, and the
+# run fails, so that the scheduled workflow shows it instead of going stale.
+if [ ${#missingPlugins[@]} -gt 0 ]; then
+  printf -v missingList '%s, ' "${missingPlugins[@]}"
+  echo "Not updating $indexJsonFile, no index entry for: ${missingList%, }"
+  exitCode=1
+elif cmp -s $newIndexJsonFile $indexJsonFile; then
+  echo "No changes in $indexJsonFile"
 else
-  echo "No changes in $indexJsonFile, skipping commit"
-fi
\ No newline at end of file
+  mv $newIndexJsonFile $indexJsonFile
+
+  # Check if indexJsonFile has changes, looking at that file only
+  if ! git diff --quiet -- $indexJsonFile; then
+    changedFiles+=("$indexJsonFile")
+  else
+    echo "No changes in $indexJsonFile"
+  fi
+fi
+
+if [ ${#changedFiles[@]} -eq 0 ]; then
+  echo "Nothing changed, skipping commit"
+  exit $exitCode
+fi
+
+if [ ${#updatedPlugins[@]} -eq 0 ]; then
+  commitMessage="Update plugin index"
+else
+  printf -v pluginList '%s, ' "${updatedPlugins[@]}"
+  commitMessage="Update plugins: ${pluginList%, }"
+fi
+
+git add "${changedFiles[@]}"
+git commit -m "$commitMessage" -m "$(printf '%s\n' "${updateMessages[@]}")" "${changedFiles[@]}"
+
+exit $exitCode